@@ -1,24 +1,129 @@
 """ copy dirs and files in parallel """
 
+import errno
 import functools
-import glob
 import os
 import shutil
+import stat
 import sys
+import threading
+from collections import OrderedDict
 from pathlib import Path
-from typing import List, Dict
+from typing import List, Dict, Tuple
 
-from parallel_traversal import parallel_recursive_apply, FileType
+from parallel_traversal import parallel_recursive_apply, print_message, \
+    FileType, fadvise, FADVISE_MIN_SIZE, expand_patterns, get_dest_path, \
+    DEFAULT_NUM_MAX_THREADS
 
-src_inode_to_dest_path: Dict[int, Path] = {}
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None  # type: ignore
+
+# entries of HardLinkTable kept at most. about 200 bytes each.
+MAX_HARD_LINK_ENTRIES = 1 << 20
+
+
+class HardLinkTable:
+    """
+    Destination of the first visited link of each hard-linked source file
+
+    An entry is dropped once all st_nlink links of its inode have been
+    visited. Inodes with links outside the copied trees never get there,
+    so the least recently used entries are evicted beyond max_entries;
+    their remaining links are then copied as separate files.
+    """
+
+    def __init__(self, max_entries: int = MAX_HARD_LINK_ENTRIES) -> None:
+        self.max_entries = max_entries
+        # (st_dev, st_ino) -> [destination of the first link,
+        #                      number of links not visited yet]
+        self._entries: 'OrderedDict[Tuple[int, int], list]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def first_dest(self, src_stat: os.stat_result, dest: str) -> str:
+        """
+        Get the destination of the first link to the inode of src_stat
+
+        :return: dest itself if this is the first link visited, which
+            then has to be copied. Exactly one of the links visited
+            concurrently gets it.
+        """
+        # inode numbers are only unique within a device
+        key = (src_stat.st_dev, src_stat.st_ino)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._entries[key] = [dest, src_stat.st_nlink - 1]
+                if len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                return dest
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self._entries[key]
+            else:
+                self._entries.move_to_end(key)
+            return entry[0]
+
+
+hard_links = HardLinkTable()
+
+# mount point of each device seen, filled by get_mount_point()
+_dev_to_mount_point: Dict[int, Path] = {}
+_mount_point_lock = threading.Lock()
+
+# bytes per copy_file_range()/sendfile() call, and buffer size of the
+# user-space fallback
+COPY_CHUNK_SIZE = 1 << 30
+COPY_BUFFER_SIZE = 1 << 20
+# ioctl sharing the extents of a file (copy-on-write clone) on linux,
+# supported by btrfs, xfs (reflink=1), bcachefs, etc.
+FICLONE = 0x40049409
+# errors meaning "this copy method is not available here, try the next one"
+_FAST_COPY_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                              errno.EOPNOTSUPP, errno.EBADF}
+# filesystems without FICLONE report EOPNOTSUPP, ENOTTY or EINVAL
+_REFLINK_FALLBACK_ERRNOS = _FAST_COPY_FALLBACK_ERRNOS | {errno.ENOTTY}
+# how regular files are reproduced:
+#   copy: always copy the data
+#   reflink: share the data copy-on-write where the filesystem supports it,
+#       copy otherwise (default)
+#   hardlink: hard link to the source, reflink or copy where impossible
+#       (e.g. across filesystems)
+LINK_MODES = ('copy', 'reflink', 'hardlink')
+# errors of unsupported extended attributes, silently ignored like copystat()
+_XATTR_IGNORED_ERRNOS = {errno.EPERM, errno.EOPNOTSUPP, errno.EINVAL,
+                         getattr(errno, 'ENODATA', errno.EINVAL)}
 
 
-@functools.lru_cache(maxsize=65536)
 def get_mount_point(absolute_path: Path) -> Path:
     """ get mount point of path """
-    if os.path.ismount(absolute_path):
-        return absolute_path
-    return get_mount_point(absolute_path.parent)
+    # the path itself may not exist (e.g. the target of a broken link),
+    # so start from its nearest existing ancestor
+    for path in (absolute_path, *absolute_path.parents):
+        try:
+            dev = os.stat(path).st_dev
+            break
+        except OSError:
+            continue
+    else:
+        return Path(absolute_path.anchor)
+
+    with _mount_point_lock:
+        mount_point = _dev_to_mount_point.get(dev)
+    # the same device can be mounted at several places (bind mounts)
+    if mount_point is not None and path.is_relative_to(mount_point):
+        return mount_point
+
+    # stat each ancestor once, stopping where the device changes
+    mount_point = path
+    for parent in path.parents:
+        if os.stat(parent).st_dev != dev:
+            break
+        mount_point = parent
+    with _mount_point_lock:
+        _dev_to_mount_point[dev] = mount_point
+    return mount_point
 
 
 def relative_to_mount(path: Path) -> Path:
@@ -27,37 +132,161 @@ def relative_to_mount(path: Path) -> Path:
     return path.absolute().relative_to(mount_point)
 
 
-def copy_dir(src: Path, src_root: Path, dest_root: Path,
-             as_child: bool) -> None:
+def open_source(src: str) -> int:
+    """ open src for reading without updating its access time if possible """
+    flags = os.O_RDONLY | getattr(os, 'O_BINARY', 0)
+    if hasattr(os, 'O_NOATIME'):
+        try:
+            return os.open(src, flags | os.O_NOATIME)
+        except PermissionError:
+            # O_NOATIME is only allowed to the owner of the file
+            pass
+    return os.open(src, flags)
+
+
+def copy_file_content(src_fd: int, dest_fd: int, size: int,
+                      reflink: bool = True) -> None:
+    """
+    copy file content between fds on linux, in kernel space where possible
+    """
+    # both fds are used with their own offsets, so a method failing in
+    # the middle can be continued by the next one
+    if reflink and fcntl is not None and size:
+        # no data is moved at all if src and dest share a filesystem
+        # supporting reflinks. fails with EXDEV across filesystems.
+        try:
+            fcntl.ioctl(dest_fd, FICLONE, src_fd)
+            return
+        except OSError as e:
+            if e.errno not in _REFLINK_FALLBACK_ERRNOS:
+                raise
+    if hasattr(os, 'copy_file_range'):
+        try:
+            copied = 0
+            while written := os.copy_file_range(src_fd, dest_fd,
+                                                COPY_CHUNK_SIZE):
+                copied += written
+            # some filesystems (e.g. procfs) report EOF immediately
+            if copied or not size:
+                return
+        except OSError as e:
+            if e.errno not in _FAST_COPY_FALLBACK_ERRNOS:
+                raise
+    # sendfile() accepts a regular file as the output only on linux
+    try:
+        while os.sendfile(dest_fd, src_fd, None, COPY_CHUNK_SIZE):
+            pass
+        return
+    except OSError as e:
+        if e.errno not in _FAST_COPY_FALLBACK_ERRNOS:
+            raise
+    with open(src_fd, 'rb', closefd=False) as src_file, \
+            open(dest_fd, 'wb', closefd=False) as dest_file:
+        shutil.copyfileobj(src_file, dest_file, COPY_BUFFER_SIZE)
+
+
+def copy_metadata(src: str, dest: str, src_stat: os.stat_result) -> None:
+    """ same as shutil.copystat() but reuses the stat already taken """
+    os.utime(dest, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+    if hasattr(os, 'listxattr'):
+        try:
+            names = os.listxattr(src, follow_symlinks=False)
+        except OSError as e:
+            if e.errno not in _XATTR_IGNORED_ERRNOS:
+                raise
+            names = []
+        for name in names:
+            try:
+                value = os.getxattr(src, name, follow_symlinks=False)
+                os.setxattr(dest, name, value, follow_symlinks=False)
+            except OSError as e:
+                if e.errno not in _XATTR_IGNORED_ERRNOS:
+                    raise
+    os.chmod(dest, stat.S_IMODE(src_stat.st_mode))
+    if hasattr(os, 'chflags') and hasattr(src_stat, 'st_flags'):
+        try:
+            os.chflags(dest, src_stat.st_flags, follow_symlinks=False)
+        except OSError as e:
+            if e.errno not in _XATTR_IGNORED_ERRNOS:
+                raise
+
+
+def hard_link_file(src: str, dest: str) -> bool:
+    """ hard link dest to src, False if it is not possible """
+    try:
+        os.link(src, dest)
+        return True
+    except OSError:
+        # EXDEV across filesystems, EPERM/EMLINK/EEXIST etc.
+        return False
+
+
+def copy_regular_file(src: str, dest: str, src_stat: os.stat_result,
+                      link_mode: str = 'reflink') -> None:
+    """
+    copy content and metadata of a regular file, like shutil.copy2()
+
+    For link_mode 'hardlink', the caller has already failed to hard link
+    dest, which is then reflinked or copied.
+    """
+    if not sys.platform.startswith('linux'):
+        # shutil uses the fast copy of the platform, e.g. fcopyfile() on
+        # macOS, rather than a loop through Python buffers
+        shutil.copyfile(src, dest)
+        copy_metadata(src, dest, src_stat)
+        return
+    src_fd = open_source(src)
+    try:
+        dest_fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC |
+                          getattr(os, 'O_BINARY', 0), 0o666)
+        try:
+            advise = hasattr(os, 'posix_fadvise') and \
+                src_stat.st_size >= FADVISE_MIN_SIZE
+            if advise:
+                fadvise(src_fd, os.POSIX_FADV_SEQUENTIAL)
+            copy_file_content(src_fd, dest_fd, src_stat.st_size,
+                              reflink=link_mode != 'copy')
+            if advise:
+                # a one-time copy should not evict the page cache of others
+                fadvise(src_fd, os.POSIX_FADV_DONTNEED)
+                fadvise(dest_fd, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(dest_fd)
+    finally:
+        os.close(src_fd)
+    copy_metadata(src, dest, src_stat)
+
+
+def copy_dir(src: str, src_root: Path, src_stat: os.stat_result,
+             dest_root: Path, as_child: bool) -> None:
     """ copy dir to the corresponding location in dest_root """
     # assume that the parent directory of dest exists
-    if as_child:
-        dest = dest_root / src_root.name / src.relative_to(src_root)
-    else:
-        dest = dest_root / src.relative_to(src_root)
+    dest = get_dest_path(src, src_root, dest_root, as_child)
     # make directory then copy metadata
     try:
-        dest.mkdir(parents=False, exist_ok=True)
-        shutil.copystat(src, dest, follow_symlinks=False)
+        try:
+            os.mkdir(dest)
+        except FileExistsError:
+            if not os.path.isdir(dest):
+                raise
+        copy_metadata(src, dest, src_stat)
     except OSError:
         import traceback
-        print(f'\r{traceback.format_exc()}')
+        print_message(f'\r{traceback.format_exc()}')
 
 
-def copy_file(src: Path, src_root: Path, dest_root: Path,
-              as_child: bool) -> None:
+def copy_file(src: str, src_root: Path, src_stat: os.stat_result,
+              dest_root: Path, as_child: bool,
+              link_mode: str = 'reflink') -> None:
     """ copy file to the corresponding location in dest_root """
-    if as_child:
-        dest = dest_root / src_root.name / src.relative_to(src_root)
-    else:
-        dest = dest_root / src.relative_to(src_root)
+    dest = get_dest_path(src, src_root, dest_root, as_child)
     # assume that the parent directory of dest exists
     try:
-        file_type = FileType.from_path(src)
+        file_type = FileType.from_stat(src_stat)
         # skip special files
         if file_type in (FileType.DEVICE, FileType.UNKNOWN):
-            print(f'\rWarning: Skipped {src}: Non-regular file (device, '
-                  f'named pipe, socket, etc.)')
+            print_message(f'\rWarning: Skipped {src}: Non-regular file '
+                          f'(device, named pipe, socket, etc.)')
             return
         if file_type in \
                 (FileType.SYMLINK, FileType.JUNCTION, FileType.WSL_SYMLINK):
@@ -68,7 +297,7 @@ def copy_file(src: Path, src_root: Path, dest_root: Path,
             else:
                 link_target = os.readlink(src)
             if link_target.startswith('\\\\?\\Volume{'):
-                print(f'\rWarning: Skipped {src}: Volume mount point')
+                print_message(f'\rWarning: Skipped {src}: Volume mount point')
                 return
             if link_target.startswith('\\\\?\\'):
                 link_target = link_target[4:]
@@ -77,90 +306,108 @@ def copy_file(src: Path, src_root: Path, dest_root: Path,
                 dest_target = link_target
                 if not os.path.lexists(link_target):
                     target_from_mount = relative_to_mount(link_target)
-                    dest_mount = get_mount_point(dest.absolute())
+                    dest_mount = get_mount_point(Path(dest).absolute())
                     if os.path.lexists(dest_mount / target_from_mount):
                         dest_target = dest_mount / target_from_mount
                         link_target = Path(os.path.relpath(dest_target, dest))
                     else:
-                        print(f'\rWarning: Skipped {src}: Broken link')
+                        print_message(f'\rWarning: Skipped {src}: Broken link')
                         return
             else:
-                dest_target = dest.parent / link_target
+                dest_target = os.path.join(os.path.dirname(dest), link_target)
             if sys.platform == 'win32':
                 if file_type in (FileType.SYMLINK, FileType.WSL_SYMLINK):
                     if file_type == FileType.WSL_SYMLINK:
-                        print('\rWarning: Treating as an ordinary symbolic '
-                              f'link: {src}: A symbolic link created in WSL')
+                        print_message('\rWarning: Treating as an ordinary '
+                                      f'symbolic link: {src}: A symbolic link '
+                                      'created in WSL')
                     try:
-                        dest.symlink_to(link_target)
+                        os.symlink(link_target, dest)
                         return
                     except OSError:
-                        if not dest_target.is_dir():
+                        if not os.path.isdir(dest_target):
                             # junctions can only point to directories
-                            print(f'\rWarning: Skipped {src}: No rights to '
-                                  'create a symbolic link (to a file)')
+                            print_message(f'\rWarning: Skipped {src}: No '
+                                          'rights to create a symbolic link '
+                                          '(to a file)')
                             return
                         import _winapi
                         try:
-                            _winapi.CreateJunction(str(link_target), str(dest))
-                            print(f'\rWarning: Copied as a junction {src}: '
-                                  'No rights to create a symbolic link')
+                            _winapi.CreateJunction(str(link_target), dest)
+                            print_message(f'\rWarning: Copied as a junction '
+                                          f'{src}: No rights to create a '
+                                          'symbolic link')
                         except FileNotFoundError:
-                            print(f'\rWarning: Skipped {src}: Broken link')
+                            print_message(f'\rWarning: Skipped {src}: Broken '
+                                          'link')
                         return
                 elif file_type == FileType.JUNCTION:
                     import _winapi
                     try:
-                        _winapi.CreateJunction(str(link_target), str(dest))
+                        _winapi.CreateJunction(str(link_target), dest)
                     except FileNotFoundError:
-                        print(f'\rWarning: Skipped {src}: Broken link')
+                        print_message(f'\rWarning: Skipped {src}: Broken link')
                     return
             else:
-                dest.symlink_to(link_target)
+                os.symlink(link_target, dest)
                 shutil.copystat(src, dest, follow_symlinks=False)
                 return
 
+        if link_mode == 'hardlink' and hard_link_file(src, dest):
+            # links to the source inode need not be tracked below
+            return
+
         # hard linked files
-        file_stat = src.lstat()
-        if file_stat.st_nlink > 1:
-            if file_stat.st_ino in src_inode_to_dest_path:
+        if not src_stat.st_nlink:
+            # the stat of a scandir() entry on Windows leaves st_nlink,
+            # st_ino and st_dev 0, which would also merge all files in
+            # hard_links. only files are stat'ed again.
+            src_stat = os.lstat(src)
+        if src_stat.st_nlink > 1:
+            link_source = hard_links.first_dest(src_stat, dest)
+            if link_source != dest:
                 # hard link to a file that has already been copied
                 try:
-                    dest.hardlink_to(src_inode_to_dest_path[file_stat.st_ino])
+                    os.link(link_source, dest)
                 except OSError:
-                    pass
-                shutil.copystat(src, dest, follow_symlinks=False)
-                print(f'\rInfo: {src} is copied as a hard link. '
-                      f'source has {file_stat.st_nlink} links, '
-                      f'destination has {dest.lstat().st_nlink} links.')
+                    # the first link may not have been created yet
+                    copy_regular_file(src, dest, src_stat, link_mode)
+                    return
+                copy_metadata(src, dest, src_stat)
+                print_message(f'\rInfo: {src} is copied as a hard link. '
+                              f'source has {src_stat.st_nlink} links, '
+                              f'destination has {os.lstat(dest).st_nlink} '
+                              'links.')
                 return
 
-            print(f'\rWarning: {src} is a hard-link. This file has '
-                  f'{file_stat.st_nlink} links.')
-            src_inode_to_dest_path[file_stat.st_ino] = dest
+            print_message(f'\rWarning: {src} is a hard-link. This file has '
+                          f'{src_stat.st_nlink} links.')
 
-        shutil.copy2(src, dest, follow_symlinks=False)
+        copy_regular_file(src, dest, src_stat, link_mode)
     except PermissionError:
-        if dest.exists():
+        if os.path.exists(dest):
             try:
                 if sys.platform == 'win32':
-                    dest.chmod(0o777)
+                    os.chmod(dest, 0o777)
                 else:
-                    dest.chmod(0o777, follow_symlinks=False)
-                dest.unlink()
-                shutil.copy2(src, dest, follow_symlinks=False)
+                    os.chmod(dest, 0o777, follow_symlinks=False)
+                os.unlink(dest)
+                copy_regular_file(src, dest, src_stat, link_mode)
             except PermissionError:
-                print(f'\rWarning: Skipped {src}: Permission denied')
+                print_message(f'\rWarning: Skipped {src}: Permission denied')
         else:
-            print(f'\rWarning: Skipped {src}: Permission denied')
+            print_message(f'\rWarning: Skipped {src}: Permission denied')
     except OSError:
         import traceback
-        print(f'\r{traceback.format_exc()}')
+        print_message(f'\r{traceback.format_exc()}')
 
 
 def parallel_cp_r(source_paths: List[str], dest_path: str,
-                  num_max_threads: int = 256) -> None:
+                  num_max_threads: int = DEFAULT_NUM_MAX_THREADS,
+                  link_mode: str = 'reflink') -> None:
     """ delete dirs and files in parallel """
+    if link_mode not in LINK_MODES:
+        raise ValueError(f"Invalid link mode: {link_mode}")
     dest = Path(dest_path)
     if dest.exists():
         if not dest.is_dir():
@@ -173,6 +420,9 @@ def parallel_cp_r(source_paths: List[str], dest_path: str,
                                      "directory when copying multiple "
                                      "sources.")
         if not os.path.isdir(source_paths[0]):
+            if link_mode == 'hardlink' and \
+                    hard_link_file(source_paths[0], dest_path):
+                return
             shutil.copy2(source_paths[0], dest_path, follow_symlinks=False)
             return
         # copy directory as a new name
@@ -183,36 +433,41 @@ def parallel_cp_r(source_paths: List[str], dest_path: str,
         dir_func=functools.partial(copy_dir, dest_root=dest,  # type: ignore
                                    as_child=as_child),
         file_func=functools.partial(copy_file, dest_root=dest,  # type: ignore
-                                    as_child=as_child),
+                                    as_child=as_child, link_mode=link_mode),
         pre_order=True,
-        num_max_threads=num_max_threads)
+        num_max_threads=num_max_threads,
+        # the callbacks only hand src to os functions
+        path_type=str)
 
 
 def main() -> None:
     """ main function """
-    if len(sys.argv) < 3:
-        print("Usage: python parallel_cp_r.py <source> <source> ... <dest>")
+    # --link[=MODE], parsed by hand to keep argparse out of the executable
+    args = []
+    link_mode = 'reflink'
+    for arg in sys.argv[1:]:
+        if arg == '--link':
+            link_mode = 'hardlink'
+        elif arg.startswith('--link='):
+            link_mode = arg[len('--link='):]
+        else:
+            args.append(arg)
+    if len(args) < 2 or link_mode not in LINK_MODES:
+        print("Usage: python parallel_cp_r.py [--link[=MODE]] <source> "
+              "<source> ... <dest>")
         print("    You can use wildcards * and ? to specify multiple "
               "files/directories for sources.")
+        print("    --link: hard link files instead of copying them where "
+              "possible.")
+        print(f"    --link=MODE: MODE is one of {', '.join(LINK_MODES)} "
+              "(default: reflink).")
         sys.exit(1)
 
     # get paths from command line arguments
-    paths = []
-    # noinspection DuplicatedCode
-    for pattern in sys.argv[1:-1]:
-        # noinspection DuplicatedCode
-        if sys.version_info >= (3, 11):
-            matches = glob.glob(pattern, recursive=True, include_hidden=True)
-        else:
-            matches = glob.glob(pattern, recursive=True)
-        if not matches:
-            # if pattern does not match anything, skip it
-            print(f"Warning: Skipped {pattern}: Does not match "
-                  "any file or directory.")
-        paths.extend(matches)
+    paths = expand_patterns(args[:-1])
 
     # copy files and directories
-    parallel_cp_r(paths, sys.argv[-1])
+    parallel_cp_r(paths, args[-1], link_mode=link_mode)
 
 
 if __name__ == "__main__":
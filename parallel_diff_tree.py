@@ -1,78 +1,105 @@
 """ compare two directories in parallel (metadata is ignored) """
 
+import errno
 import functools
 import os
-import shutil
+import stat
 import sys
-import threading
 from pathlib import Path
-from typing import Set, Union
+from typing import Optional
 
-from parallel_traversal import parallel_recursive_apply
+from parallel_traversal import parallel_recursive_apply, print_message, \
+    fadvise, FADVISE_MIN_SIZE, get_terminal_width, DEFAULT_NUM_MAX_THREADS
 
-print_lock = threading.Lock()
+# the errors that Path.exists() takes for a missing path, e.g. ELOOP for
+# a symlink loop
+_IGNORED_ERRNOS = (errno.ENOENT, errno.ENOTDIR, errno.EBADF, errno.ELOOP)
+# ERROR_NOT_READY, ERROR_INVALID_NAME, ERROR_CANT_RESOLVE_FILENAME
+_IGNORED_WINERRORS = (21, 123, 1921)
 
 
-def diff_dir(src: Path, src_root: Path, dest_root: Path) -> None:
+def stat_or_none(path: Path) -> Optional[os.stat_result]:
+    """ stat() following links, None where Path.exists() is False """
+    try:
+        return path.stat()
+    except OSError as e:
+        if e.errno in _IGNORED_ERRNOS or \
+                getattr(e, 'winerror', None) in _IGNORED_WINERRORS:
+            return None
+        raise
+
+
+def diff_dir(src: Path, src_root: Path, src_stat: os.stat_result,
+             dest_root: Path) -> None:
     """ compare src dir to the corresponding location in dest_root """
-    terminal_width = shutil.get_terminal_size().columns
     dest = dest_root / src.relative_to(src_root)
-    if not dest.exists():
-        with print_lock:
-            print(f"\rDELETED Dir: {src} -> x".ljust(terminal_width))
-    elif not dest.is_dir():
-        with print_lock:
-            print(f"\rPROPERTY CHANGED [DIR]{src} -> [FILE]{dest}".ljust(
-                terminal_width))
+    dest_stat = stat_or_none(dest)
+    if dest_stat is None:
+        print_message(f"\rDELETED Dir: {src} -> x".ljust(get_terminal_width()))
+    elif not stat.S_ISDIR(dest_stat.st_mode):
+        print_message(f"\rPROPERTY CHANGED [DIR]{src} -> [FILE]{dest}"
+                      .ljust(get_terminal_width()))
     else:
         # report created direct children
-        src_children: Set[Union[str, bytes, os.PathLike]] = set(os.listdir(src))
-        dest_children: Set[Union[str, bytes, os.PathLike]] = \
-            set(os.listdir(dest))
-        for child in dest_children - src_children:
-            if (dest / child).is_dir():
-                with print_lock:
-                    print(f"\rCREATED Dir (maybe also children, "
-                          f"not checked): x -> {child}".ljust(terminal_width))
+        with os.scandir(src) as it:
+            src_names = {entry.name for entry in it}
+        with os.scandir(dest) as it:
+            dest_entries = {entry.name: entry for entry in it}
+        for child in dest_entries.keys() - src_names:
+            # d_type from readdir answers this without another stat
+            if dest_entries[child].is_dir(follow_symlinks=False):
+                print_message(f"\rCREATED Dir (maybe also children, "
+                              f"not checked): x -> {child}"
+                              .ljust(get_terminal_width()))
             else:
-                with print_lock:
-                    print(f"\rCREATED File: x -> {child}".ljust(terminal_width))
+                print_message(f"\rCREATED File: x -> {child}"
+                              .ljust(get_terminal_width()))
 
 
-def diff_file(src: Path, src_root: Path, dest_root: Path) -> None:
+def diff_file(src: Path, src_root: Path, src_stat: os.stat_result,
+              dest_root: Path) -> None:
     """ compare src file to the corresponding location in dest_root """
-    terminal_width = shutil.get_terminal_size().columns
     dest = dest_root / src.relative_to(src_root)
-    if not dest.exists():
-        with print_lock:
-            print(f"\rDELETED File: {src} -> x".ljust(terminal_width))
-    elif not dest.is_file():
-        with print_lock:
-            print(f"\rPROPERTY CHANGED [FILE] {src} -> [DIR] {dest}".ljust(
-                terminal_width))
+    dest_stat = stat_or_none(dest)
+    if dest_stat is None:
+        print_message(f"\rDELETED File: {src} -> x"
+                      .ljust(get_terminal_width()))
+    elif not stat.S_ISREG(dest_stat.st_mode):
+        print_message(f"\rPROPERTY CHANGED [FILE] {src} -> [DIR] {dest}"
+                      .ljust(get_terminal_width()))
     else:
-        # compare size
-        if src.stat().st_size != dest.stat().st_size:
-            with print_lock:
-                print(f"\rSIZE CHANGED File: [{src.stat().st_size}] {src} -> "
-                      f"[{dest.stat().st_size}] {dest}".ljust(terminal_width))
+        # compare size. links are compared by their targets.
+        if stat.S_ISLNK(src_stat.st_mode):
+            src_stat = src.stat()
+        if src_stat.st_size != dest_stat.st_size:
+            print_message(f"\rSIZE CHANGED File: [{src_stat.st_size}] "
+                          f"{src} -> [{dest_stat.st_size}] {dest}"
+                          .ljust(get_terminal_width()))
             return
         # compare content
         with src.open("rb") as src_file, dest.open("rb") as dest_file:
+            advise = hasattr(os, 'posix_fadvise') and \
+                src_stat.st_size >= FADVISE_MIN_SIZE
+            if advise:
+                for file in (src_file, dest_file):
+                    fadvise(file.fileno(), os.POSIX_FADV_SEQUENTIAL)
             while True:
                 src_data = src_file.read(128 * 1024)
                 dest_data = dest_file.read(128 * 1024)
                 if src_data != dest_data:
-                    with print_lock:
-                        print(f"\rCONTENT CHANGED File: {src} -> {dest}".ljust(
-                            terminal_width))
+                    print_message(f"\rCONTENT CHANGED File: {src} -> {dest}"
+                                  .ljust(get_terminal_width()))
                     break
                 if not src_data:
                     break
+            if advise:
+                # both trees are read once, don't evict the cache of others
+                for file in (src_file, dest_file):
+                    fadvise(file.fileno(), os.POSIX_FADV_DONTNEED)
 
 
 def parallel_diff_tree(source_path: str, dest_path: str,
-                       num_max_threads: int = 512) -> None:
+                       num_max_threads: int = DEFAULT_NUM_MAX_THREADS) -> None:
     """ compare two directories in parallel (metadata is ignored) """
     source = Path(source_path)
     dest = Path(dest_path)
@@ -91,8 +118,7 @@ def parallel_diff_tree(source_path: str, dest_path: str,
         file_func=functools.partial(diff_file, dest_root=dest),  # type: ignore
         num_max_threads=num_max_threads,
         pre_order=False,
-        strict_hierarchical_order=True,
-        print_lock=print_lock
+        strict_hierarchical_order=True
     )
 
 
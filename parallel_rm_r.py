@@ -1,16 +1,16 @@
 """ delete dirs and files in parallel """
 
 import functools
-import glob
 import os
 import sys
 from pathlib import Path
 from typing import List
 
-from parallel_traversal import parallel_recursive_apply
+from parallel_traversal import parallel_recursive_apply, expand_patterns, \
+    print_message, DEFAULT_NUM_MAX_THREADS
 
 
-def force_delete(path: Path, _, is_dir: bool) -> None:
+def force_delete(path: Path, _root, _stat, is_dir: bool) -> None:
     """ delete file or dir even if it is read-only """
     try:
         if is_dir:
@@ -44,17 +44,19 @@ def force_delete(path: Path, _, is_dir: bool) -> None:
         else:
             proc = None
         if proc is not None:
-            print(f"Failed to delete {path!r} because it is locked by "
-                  f"process {proc.name()} (pid={proc.pid}).")
-            print("Parent processes:")
+            # one message, so that lines of other threads don't come between
+            lines = [f"\rFailed to delete {path!r} because it is locked by "
+                     f"process {proc.name()} (pid={proc.pid}).",
+                     "Parent processes:"]
             for i, parent in enumerate(proc.parents()):
-                print(f"{'  ' * i}`- {parent.name()} "
-                      f"({parent.pid})")
+                lines.append(f"{'  ' * i}`- {parent.name()} ({parent.pid})")
+            print_message("\n".join(lines))
         # reraise anyway
         raise
 
 
-def parallel_rm_r(paths: List[str], num_max_threads: int = 512) -> None:
+def parallel_rm_r(paths: List[str],
+                  num_max_threads: int = DEFAULT_NUM_MAX_THREADS) -> None:
     """ delete dirs and files in parallel """
     parallel_recursive_apply(
         paths,
@@ -74,17 +76,7 @@ def main() -> None:
         sys.exit(1)
 
     # get paths from command line arguments
-    paths = []
-    for pattern in sys.argv[1:]:
-        if sys.version_info >= (3, 11):
-            matches = glob.glob(pattern, recursive=True, include_hidden=True)
-        else:
-            matches = glob.glob(pattern, recursive=True)
-        if not matches:
-            # if pattern does not match anything, skip it
-            print(f"Warning: Skipped {pattern}: Does not match "
-                  "any file or directory.")
-        paths.extend(matches)
+    paths = expand_patterns(sys.argv[1:])
 
     # delete dirs and files in parallel
     parallel_rm_r(paths)
@@ -1,52 +1,126 @@
 import argparse
 import functools
 import getpass
-import glob
 import os
 import re
-import sys
-from pathlib import Path
+import shlex
+import stat
+from pathlib import Path, PurePosixPath
 from queue import Queue
+from typing import Dict, List
 
 import paramiko
 
-from parallel_traversal import parallel_recursive_apply
+from parallel_traversal import parallel_recursive_apply, print_message, \
+    FileType, expand_patterns, walk_pre_order, get_dest_path
 
+# OpenSSH allows 10 sessions per connection by default (MaxSessions)
+DEFAULT_CHANNELS_PER_CONNECTION = 8
+# a remote command is a single argument of `sh -c`, which linux limits to
+# 128 KiB (MAX_ARG_STRLEN)
+MAX_REMOTE_COMMAND_LENGTH = 64 * 1024
+# AES-GCM encrypts and authenticates a packet in a single OpenSSL (AES-NI)
+# call, whereas the other ciphers need a separate HMAC pass over it.
+PREFERRED_CIPHERS = ('aes128-gcm@openssh.com', 'aes256-gcm@openssh.com',
+                     'aes128-ctr')
 
-def scp_dir(src: Path, src_root: Path, dest_root: Path, as_child: bool,
+
+def fast_cipher_transport(sock, *args, **kwargs) -> paramiko.Transport:
+    """ transport_factory offering PREFERRED_CIPHERS first """
+    transport = paramiko.Transport(sock, *args, **kwargs)
+    options = transport.get_security_options()
+    # moved to the front one at a time, last first, so that a cipher the
+    # installed paramiko lacks only drops itself
+    for cipher in reversed(PREFERRED_CIPHERS):
+        try:
+            options.ciphers = (cipher,) + tuple(
+                other for other in options.ciphers if other != cipher)
+        except ValueError:
+            # unknown to the installed paramiko
+            pass
+    return transport
+
+
+def collect_remote_dirs(source_paths: List[str], dest_root: PurePosixPath,
+                        as_child: bool) -> Dict[int, List[str]]:
+    """ get remote directories to create for source_paths, by mode """
+    mode_to_dirs: Dict[int, List[str]] = {}
+    for source_path in source_paths:
+        if not os.path.isdir(source_path):
+            continue
+        root = Path(source_path)
+        dir_modes = {os.fspath(root): root.stat().st_mode}
+        for parent, dir_entries, _ in walk_pre_order(root):
+            mode = stat.S_IMODE(dir_modes.pop(parent))
+            mode_to_dirs.setdefault(mode, []).append(
+                get_dest_path(parent, root, dest_root, as_child))
+            # same as the traversal: don't descend into links or junctions.
+            # d_type of the listing tells them apart without an lstat().
+            dir_entries[:] = [
+                entry for entry in dir_entries
+                if FileType.from_entry(entry) == FileType.DIRECTORY]
+            for entry in dir_entries:
+                dir_modes[entry.path] = \
+                    entry.stat(follow_symlinks=False).st_mode
+    return mode_to_dirs
+
+
+def run_batched(client: paramiko.SSHClient, command: str,
+                paths: List[str]) -> None:
+    """ run `command paths...` remotely, split to fit the length limit """
+    batches: List[List[str]] = []
+    length = MAX_REMOTE_COMMAND_LENGTH
+    for path in paths:
+        quoted = shlex.quote(path)
+        if length + 1 + len(quoted) > MAX_REMOTE_COMMAND_LENGTH:
+            batches.append([])
+            length = len(command)
+        batches[-1].append(quoted)
+        length += 1 + len(quoted)
+    for batch in batches:
+        _, stdout, stderr = client.exec_command(f'{command} {" ".join(batch)}')
+        if stdout.channel.recv_exit_status() != 0:
+            raise OSError(f'{command} failed: '
+                          f'{stderr.read().decode(errors="replace")}')
+
+
+def skip_dir(src: str, src_root: Path, src_stat: os.stat_result) -> None:
+    """ directories already exist when `mkdir -p` succeeded """
+
+
+def scp_dir(src: str, src_root: Path, src_stat: os.stat_result,
+            dest_root: PurePosixPath, as_child: bool,
             connections: Queue) -> None:
     """ scp src dir to the corresponding location in dest_root """
-    dest = dest_root / src.relative_to(src_root)
-    if as_child:
-        dest = dest.parent
+    dest = get_dest_path(src, src_root, dest_root, as_child)
     # assume that the parent directory of dest exists
     sftp = connections.get()
     try:
-        sftp.mkdir(str(dest), mode=src.stat().st_mode)
+        sftp.mkdir(dest, mode=src_stat.st_mode)
     except OSError:
         import traceback
-        print(f'\r{traceback.format_exc()}')
+        print_message(f'\r{traceback.format_exc()}')
     connections.put(sftp)
 
 
-def scp_file(src: Path, src_root: Path, dest_root: Path, as_child: bool,
+def scp_file(src: str, src_root: Path, src_stat: os.stat_result,
+             dest_root: PurePosixPath, as_child: bool,
              connections: Queue) -> None:
     """ scp src file to the corresponding location in dest_root """
-    dest = dest_root / src.relative_to(src_root)
-    if as_child:
-        dest = dest.parent
+    dest = get_dest_path(src, src_root, dest_root, as_child)
     # assume that the parent directory of dest exists
     sftp = connections.get()
     try:
-        sftp.put(str(src), str(dest), confirm=False)
+        sftp.put(src, dest, confirm=False)
     except OSError:
         import traceback
-        print(f'\r{traceback.format_exc()}')
+        print_message(f'\r{traceback.format_exc()}')
     connections.put(sftp)
 
 
 def parallel_scp_r(dest_host, dest_port, dest_user, identity_filename,
-                   source_paths, dest_path, num_max_threads):
+                   source_paths, dest_path, num_max_threads,
+                   channels_per_connection=DEFAULT_CHANNELS_PER_CONNECTION):
     # Try authentication
     client = paramiko.SSHClient()
     client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
@@ -65,51 +139,88 @@ def parallel_scp_r(dest_host, dest_port, dest_user, identity_filename,
     for key in keys:
         try:
             client.connect(dest_host, port=dest_port, username=dest_user,
-                           key_filename=key)
+                           key_filename=key,
+                           transport_factory=fast_cipher_transport)
             authentication['key_filename'] = key
             break
         except paramiko.ssh_exception.AuthenticationException:
             pass
     # Try password
-    for _ in range(3):
-        try:
-            password = getpass.getpass(f'{dest_user}@{dest_host}\'s password: ')
-            client.connect(dest_host, port=dest_port, username=dest_user,
-                           password=password)
-            authentication['password'] = password
-            break
-        except paramiko.ssh_exception.AuthenticationException:
-            pass
-    else:
-        raise paramiko.ssh_exception.AuthenticationException(
-            'Authentication failed.')
-    # Make connection pool
-    connections = Queue(maxsize=num_max_threads)
-    connections.put(client.open_sftp())
-    print(f'Establishing {num_max_threads} connections.')
-    for i in range(num_max_threads - 1):
+    if not authentication:
+        for _ in range(3):
+            try:
+                password = getpass.getpass(
+                    f'{dest_user}@{dest_host}\'s password: ')
+                client.connect(dest_host, port=dest_port, username=dest_user,
+                               password=password,
+                               transport_factory=fast_cipher_transport)
+                authentication['password'] = password
+                break
+            except paramiko.ssh_exception.AuthenticationException:
+                pass
+        else:
+            raise paramiko.ssh_exception.AuthenticationException(
+                'Authentication failed.')
+    # Make connection pool. Each SSH connection carries several SFTP
+    # channels, which saves a TCP and SSH handshake per channel.
+    num_connections = -(-num_max_threads // channels_per_connection)
+    clients = [client]
+    print(f'Establishing {num_connections} connections.')
+    for i in range(num_connections - 1):
         client = paramiko.SSHClient()
         client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         client.connect(dest_host, port=dest_port, username=dest_user,
+                       transport_factory=fast_cipher_transport,
                        **authentication)
-        connections.put(client.open_sftp())
-        print(f'\r{i + 1}/{num_max_threads} connections established.',
+        clients.append(client)
+        print(f'\r{i + 1}/{num_connections - 1} connections established.',
               end='', flush=True)
     print()
+    connections = Queue(maxsize=num_max_threads)
+    for i in range(num_max_threads):
+        connections.put(clients[i % num_connections].open_sftp())
+    dest_root = PurePosixPath(dest_path)
+    # Create the directory skeleton with a few `mkdir -p` commands instead
+    # of one SFTP round trip per directory. Servers without a POSIX shell
+    # fall back to sftp.mkdir() from scp_dir().
+    mode_to_dirs = collect_remote_dirs(source_paths, dest_root, True)
+    try:
+        run_batched(clients[0], 'mkdir -p --',
+                    [path for paths in mode_to_dirs.values() for path in paths])
+        dirs_created = True
+    except (OSError, paramiko.SSHException) as e:
+        print(f'Warning: Creating directories one by one: {e}')
+        dirs_created = False
     # Copy
+    if dirs_created:
+        dir_func = skip_dir
+    else:
+        dir_func = functools.partial(  # type: ignore
+            scp_dir, dest_root=dest_root,
+            as_child=True, connections=connections)
     parallel_recursive_apply(
         source_paths,
-        dir_func=functools.partial(  # type: ignore
-            scp_dir, dest_root=Path(dest_path),
-            as_child=True, connections=connections),
+        dir_func=dir_func,
         file_func=functools.partial(  # type: ignore
-            scp_file, dest_root=Path(dest_path),
+            scp_file, dest_root=dest_root,
             as_child=True, connections=connections),
         pre_order=True,
-        num_max_threads=num_max_threads)
+        num_max_threads=num_max_threads,
+        # parents need not be visited first once the directories exist
+        strict_hierarchical_order=not dirs_created,
+        path_type=str)
+    if dirs_created:
+        # after the copy, so that read-only directories can be filled
+        try:
+            for mode, paths in mode_to_dirs.items():
+                run_batched(clients[0], f'chmod {mode:o} --', paths)
+        except (OSError, paramiko.SSHException) as e:
+            print(f'Warning: Failed to copy directory modes: {e}')
     # Close connections
     for _ in range(num_max_threads):
         connections.get().close()
+    for client in clients:
+        client.close()
 
 
 def main():
@@ -125,6 +236,9 @@ def main():
                         help='port number')
     parser.add_argument('-i', '--identity', type=str, default=None,
                         help='identity file')
+    parser.add_argument('-c', '--channels-per-connection', type=int,
+                        default=DEFAULT_CHANNELS_PER_CONNECTION,
+                        help='number of SFTP channels per SSH connection')
     args = parser.parse_args()
 
     # remote_dest -> user@host:path
@@ -137,22 +251,10 @@ def main():
     dest_path = m.group('path')
 
     # src -> paths
-    paths = []
-    # noinspection DuplicatedCode
-    for pattern in args.local_src:
-        # noinspection DuplicatedCode
-        if sys.version_info >= (3, 11):
-            matches = glob.glob(pattern, recursive=True, include_hidden=True)
-        else:
-            matches = glob.glob(pattern, recursive=True)
-        if not matches:
-            # if pattern does not match anything, skip it
-            print(f"Warning: Skipped {pattern}: Does not match "
-                  "any file or directory.")
-        paths.extend(matches)
+    paths = expand_patterns(args.local_src)
 
     parallel_scp_r(dest_host, args.port, dest_user, args.identity, paths,
-                   dest_path, args.threads)
+                   dest_path, args.threads, args.channels_per_connection)
 
 
 if __name__ == '__main__':
@@ -1,20 +1,85 @@
 import enum
 import functools
+import glob
 import os
+import queue
 import re
 import shutil
+import signal
 import stat
 import sys
 import threading
 import time
-from concurrent.futures import Future, ThreadPoolExecutor, wait
-from pathlib import Path
-from typing import Iterable, List, Optional, Callable, Any
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path, PurePath, PurePosixPath
+from typing import Iterable, List, Optional, Callable, Any, Tuple, Dict
 
 from wcwidth import wcwidth, wcswidth
 
 
-def walk_post_order(top):
+def expand_patterns(patterns: Iterable[str]) -> List[str]:
+    """ expand wildcards (* ? [] **) of command line paths, like a shell """
+    paths = []
+    for pattern in patterns:
+        if not glob.has_magic(pattern):
+            # most arguments are plain paths: no need to build a matcher
+            matches = [pattern] if os.path.lexists(pattern) else []
+        elif sys.version_info >= (3, 11):
+            matches = glob.glob(pattern, recursive=True, include_hidden=True)
+        else:
+            matches = glob.glob(pattern, recursive=True)
+        if not matches:
+            # if pattern does not match anything, skip it
+            print(f"Warning: Skipped {pattern}: Does not match "
+                  "any file or directory.")
+        paths.extend(matches)
+    return paths
+
+
+def walk_pre_order(top):
+    """
+    os.walk(top) that yields scandir() entries instead of names
+
+    Yields (top, dir_entries, nondir_entries). Like os.walk(), entries
+    removed from dir_entries are not descended into. The entries carry
+    the file types and, on Windows, the stats read with the directory.
+    """
+    stack = [os.fspath(top)]
+    while stack:
+        top = stack.pop()
+        dirs = []
+        nondirs = []
+        # unreadable directories are skipped, same as os.walk()
+        try:
+            scandir_it = os.scandir(top)
+        except OSError:
+            continue
+        with scandir_it:
+            try:
+                for entry in scandir_it:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        dirs.append(entry)
+                    else:
+                        nondirs.append(entry)
+            except OSError:
+                # keep what was listed before the error
+                pass
+        yield top, dirs, nondirs
+        # visit the children in listing order
+        stack.extend(reversed([entry.path for entry in dirs]))
+
+
+def walk_post_order(top, top_entry=None):
+    """
+    Bottom-up os.walk(top) that yields scandir() entries instead of names
+
+    Yields (top, top_entry, dir_entries, nondir_entries). top_entry is the
+    entry top was listed as in its parent, None for the top given.
+    """
     # Modified from os.walk()
     dirs = []
     nondirs = []
@@ -28,11 +93,9 @@ def walk_post_order(top):
     scandir_it = os.scandir(top)
 
     with scandir_it:
-        while True:
-            try:
-                entry = next(scandir_it)
-            except StopIteration:
-                break
+        # C-level iteration: no StopIteration caught per directory, and no
+        # next() call per entry
+        for entry in scandir_it:
             try:
                 is_dir = entry.is_dir()
             except OSError:
@@ -40,37 +103,93 @@ def walk_post_order(top):
                 # a directory, same behaviour than os.path.isdir().
                 is_dir = False
 
-            if is_dir:
-                dirs.append(entry.name)
+            if not is_dir:
+                nondirs.append(entry)
             else:
-                nondirs.append(entry.name)
-
-            if is_dir:
+                dirs.append(entry)
                 # Bottom-up: recurse into sub-directory, but exclude symlinks to
-                # directories if followlinks is False
-                try:
-                    os.readlink(entry.path)
-                    is_symlink = True
-                except OSError:
-                    # If os.readlink() raises an OSError, consider that the
-                    # entry is not a symbolic link.
-                    is_symlink = False
-                walk_into = not is_symlink
+                # directories if followlinks is False. d_type of the listing
+                # tells symlinks without a syscall.
+                walk_into = not entry.is_symlink()
+                if walk_into and sys.platform == "win32":
+                    # junctions are not reported by is_symlink(). the stat
+                    # of an entry comes with the listing on Windows.
+                    walk_into = not is_junction(
+                        entry.stat(follow_symlinks=False))
 
                 if walk_into:
-                    walk_dirs.append(entry.path)
+                    walk_dirs.append(entry)
 
     # Yield before recursion if going top down
     # Recurse into sub-directories
-    for new_path in walk_dirs:
-        yield from walk_post_order(new_path)
+    for entry in walk_dirs:
+        yield from walk_post_order(entry.path, entry)
     # Yield after recursion going bottom up
-    yield top, dirs, nondirs
+    yield top, top_entry, dirs, nondirs
+
 
+# bare drive letters like "C:", see parallel_recursive_apply()
+_DRIVE_LETTER_REGEX = re.compile(r"^[a-zA-Z]:$")
 
-num_done_files = 0
-num_done_dirs = 0
-num_done_bytes = 0
+
+class _DoneCounters:
+    """ numbers of items done by one thread """
+    __slots__ = ('files', 'dirs', 'bytes')
+
+    def __init__(self) -> None:
+        self.files = 0
+        self.dirs = 0
+        self.bytes = 0
+
+
+# each thread counts in its own _DoneCounters, summed by get_done_counts()
+_thread_local = threading.local()
+_all_done_counters: List[_DoneCounters] = []
+_all_done_counters_lock = threading.Lock()
+
+
+def _get_done_counters() -> _DoneCounters:
+    """ get the counters of the current thread """
+    try:
+        return _thread_local.done_counters
+    except AttributeError:
+        counters = _DoneCounters()
+        with _all_done_counters_lock:
+            _all_done_counters.append(counters)
+        _thread_local.done_counters = counters
+        return counters
+
+
+def get_done_counts() -> Tuple[int, int, int]:
+    """ get the numbers of files, dirs and bytes done by all threads """
+    with _all_done_counters_lock:
+        all_counters = list(_all_done_counters)
+    return (sum(counters.files for counters in all_counters),
+            sum(counters.dirs for counters in all_counters),
+            sum(counters.bytes for counters in all_counters))
+
+
+def reset_done_counts() -> None:
+    """ start counting from zero """
+    with _all_done_counters_lock:
+        # threads keep their counters, so zero them rather than drop them
+        for counters in _all_done_counters:
+            counters.files = counters.dirs = counters.bytes = 0
+
+
+# reparse tag of junctions and volume mount points (stat.py only has it on
+# Windows)
+IO_REPARSE_TAG_MOUNT_POINT = 0xA0000003
+# reparse tags of symlinks created in WSL, and of deduplicated files, see
+# reparse_points.ReparseTag
+IO_REPARSE_TAG_LX_SYMLINK = 0xA000001D
+IO_REPARSE_TAG_DEDUP = 0x80000013
+
+
+def is_junction(st: os.stat_result) -> bool:
+    """ tell a junction (or volume mount point) from its lstat() result """
+    # S_ISLNK is false for junctions. st_reparse_tag only exists on Windows.
+    return getattr(st, 'st_reparse_tag', 0) == IO_REPARSE_TAG_MOUNT_POINT
 
 
 class FileType(enum.Enum):
@@ -85,33 +204,45 @@ class FileType(enum.Enum):
     UNKNOWN = enum.auto()
 
     @staticmethod
-    def from_path(path: Path) -> 'FileType':
-        """ get file type from path """
+    def from_entry(entry: os.DirEntry) -> 'FileType':
+        """ get file type from a scandir() entry, caching its lstat() """
+        if sys.platform != "win32":
+            # d_type of the listing tells directories (not links to them)
+            # without a stat. junctions only exist on Windows.
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    return FileType.DIRECTORY
+            except OSError:
+                pass
         try:
-            mode = path.lstat().st_mode
+            st = entry.stat(follow_symlinks=False)
         except FileNotFoundError:
             return FileType.NONEXISTENT
+        return FileType.from_stat(st)
+
+    @staticmethod
+    def from_stat(st: os.stat_result) -> 'FileType':
+        """ get file type from an lstat() result """
+        mode = st.st_mode
         if stat.S_ISLNK(mode):
             return FileType.SYMLINK
-        try:
-            os.readlink(path)
+        if is_junction(st):
             return FileType.JUNCTION
-        except (OSError, ValueError):
-            pass
         if stat.S_ISDIR(mode):
             return FileType.DIRECTORY
         if stat.S_ISREG(mode):
-            if sys.platform == "win32":
-                import reparse_points
-                if reparse_points.is_reparse_point(path):
-                    reparse_tag, _ = reparse_points.get_reparse_info(path)
-                    if reparse_tag == \
-                        reparse_points.ReparseTag.IO_REPARSE_TAG_LX_SYMLINK:
-                        return FileType.WSL_SYMLINK
-                    if reparse_tag == \
-                        reparse_points.ReparseTag.IO_REPARSE_TAG_DEDUP:
-                        return FileType.FILE
-                    return FileType.UNKNOWN
+            # the lstat() of Windows carries the attributes and reparse tag,
+            # from the listing for scandir() entries, so reparse points
+            # need not be opened to be told apart
+            if sys.platform == "win32" and \
+                    st.st_file_attributes & stat.FILE_ATTRIBUTE_REPARSE_POINT:
+                reparse_tag = st.st_reparse_tag
+                if reparse_tag == IO_REPARSE_TAG_LX_SYMLINK:
+                    return FileType.WSL_SYMLINK
+                if reparse_tag == IO_REPARSE_TAG_DEDUP:
+                    # deduplicated data reads as a regular file
+                    return FileType.FILE
+                return FileType.UNKNOWN
             return FileType.FILE
 
         if stat.S_ISBLK(mode) or stat.S_ISCHR(mode) or stat.S_ISFIFO(mode) or \
@@ -120,73 +251,201 @@ class FileType(enum.Enum):
         return FileType.UNKNOWN
 
 
+# files smaller than this are not worth the fadvise() syscalls
+FADVISE_MIN_SIZE = 1 << 20
+
+
+def fadvise(fd: int, advice: int) -> None:
+    """ posix_fadvise() the whole file, ignoring errors as it is a hint """
+    # callers check hasattr(os, 'posix_fadvise'), as the POSIX_FADV_*
+    # constants are missing as well where it is (e.g. windows)
+    try:
+        os.posix_fadvise(fd, 0, 0, advice)
+    except OSError:
+        pass
+
+
+SIZE_UNITS = ('B', 'KiB', 'MiB', 'GiB', 'TiB', 'PiB')
+
+
+@functools.lru_cache(maxsize=None)
+def get_dest_prefix(src_root: Path, dest_root: PurePath,
+                    as_child: bool) -> Tuple[int, str, str]:
+    """
+    get what get_dest_path() needs of a root, computed once per root
+
+    dest_root is a Path for a local destination, or e.g. a PurePosixPath
+    for a remote one, whose separator is used.
+
+    :return: (length of the src_root prefix of its descendants,
+        destination of src_root, the same with a trailing separator)
+    """
+    # the walker hands over paths that start with the str of their root,
+    # './' included for the root '.'
+    src_prefix_length = len(os.fspath(src_root))
+    if as_child and src_root.name:
+        dest_root = dest_root / src_root.name
+    dest_base = str(dest_root)
+    sep = '/' if isinstance(dest_root, PurePosixPath) else '\\'
+    # anchors such as '/' already end with a separator
+    dest_prefix = dest_base if dest_base.endswith(sep) else dest_base + sep
+    return src_prefix_length, dest_base, dest_prefix
+
+
+def get_dest_path(src: str, src_root: Path, dest_root: PurePath,
+                  as_child: bool) -> str:
+    """ get the location of src in dest_root, by string operations only """
+    src_prefix_length, dest_base, dest_prefix = \
+        get_dest_prefix(src_root, dest_root, as_child)
+    # strip separators so that roots like '/' and 'C:\\' work as well
+    relative = src[src_prefix_length:].lstrip(os.sep)
+    if not relative or relative == os.curdir:
+        return dest_base
+    if dest_prefix[-1] != os.sep:
+        # a remote posix destination of a windows source
+        relative = relative.replace(os.sep, '/')
+    return dest_prefix + relative
+
+
 def pretty_size(size: float) -> str:
     """ pretty print file size """
     if size < 1024:
-        return f"{size} B"
-    if size < 1024 * 1024:
-        return f"{size / 1024:.2f} KiB"
-    if size < 1024 * 1024 * 1024:
-        return f"{size / 1024 / 1024:.2f} MiB"
-    return f"{size / 1024 / 1024 / 1024:.2f} GiB"
+        return f"{size:.0f} B"
+    # 1024 ** i <= size, from the bit length instead of chained compares
+    i = min((int(size).bit_length() - 1) // 10, len(SIZE_UNITS) - 1)
+    return f"{size / (1 << (10 * i)):.2f} {SIZE_UNITS[i]}"
 
 
 def pretty_time(seconds: float) -> str:
     """ pretty print time """
     if seconds < 60:
         return f"{seconds:.2f} s"
-    if seconds < 60 * 60:
-        return f"{seconds / 60:2.0f}:{seconds % 60:02.0f}"
-    if seconds < 60 * 60 * 24:
-        return f"{seconds / 60 / 60:2.0f}:{seconds % 60 / 60:02.0f}:" \
-               f"{seconds % 60 % 60:02.0f}"
+    minutes, seconds = divmod(int(seconds), 60)
+    if minutes < 60:
+        return f"{minutes:2d}:{seconds:02d}"
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:2d}:{minutes:02d}:{seconds:02d}"
+
+
+# seconds get_terminal_width() reuses a width, unless SIGWINCH says it changed
+TERMINAL_WIDTH_TTL = 1.0
+_terminal_width = 80
+_terminal_width_time = float('-inf')
+
+
+def get_terminal_width() -> int:
+    """ get the terminal width without querying it for every line """
+    global _terminal_width, _terminal_width_time
+    now = time.monotonic()
+    if now - _terminal_width_time > TERMINAL_WIDTH_TTL:
+        _terminal_width = shutil.get_terminal_size().columns
+        _terminal_width_time = now
+    return _terminal_width
+
 
+def _invalidate_terminal_width(*_) -> None:
+    """ SIGWINCH handler: query the width again on the next line """
+    global _terminal_width_time
+    _terminal_width_time = float('-inf')
 
-start_time = 0
-last_print_time = 0
+
+def _install_sigwinch_handler() -> Any:
+    """
+    install _invalidate_terminal_width() for SIGWINCH, where possible
+
+    Handlers can only be set from the main thread. Elsewhere the width is
+    only queried again after TERMINAL_WIDTH_TTL.
+
+    :return: the handler it replaced, for _restore_sigwinch_handler(), or
+        None if it installed nothing
+    """
+    if not hasattr(signal, 'SIGWINCH') or \
+            threading.current_thread() is not threading.main_thread():
+        return None
+    return signal.signal(signal.SIGWINCH, _invalidate_terminal_width)
+
+
+def _restore_sigwinch_handler(previous_handler: Any) -> None:
+    """ put back the handler replaced by _install_sigwinch_handler() """
+    # None also stands for a handler not installed from Python, which
+    # cannot be put back
+    if previous_handler is not None:
+        signal.signal(signal.SIGWINCH, previous_handler)
+
+
+# time.monotonic() at the start of parallel_recursive_apply()
+start_time = 0.0
+# the printer thread prints the progress once per PROGRESS_INTERVAL_NS
+PROGRESS_INTERVAL_NS = 100_000_000
+
+
+# paths repeat few distinct characters
+_cached_wcwidth = functools.lru_cache(maxsize=8192)(wcwidth)
+
+
+def _str_width(s: str) -> int:
+    """ number of columns of s, without width tables for printable ASCII """
+    if s.isascii() and s.isprintable():
+        return len(s)
+    return wcswidth(s)
 
 
 def truncate_str_end(s: str, max_width: int) -> str:
     """Truncate a string from the end to fit within a certain width."""
     width = 0
-    result = ""
-    for char in s:
-        char_width = wcwidth(char)
+    for i, char in enumerate(s):
+        # printable ASCII is always 1 column wide
+        char_width = 1 if ' ' <= char < '\x7f' else _cached_wcwidth(char)
         if width + char_width > max_width:
-            break
-        result += char
+            # the answer is a prefix of s, no need to build it
+            return s[:i]
         width += char_width
-    return result
+    return s
+
+
+def truncate_str_start(s: str, max_width: int) -> str:
+    """Truncate a string from the start to fit within a certain width."""
+    width = 0
+    for i in range(len(s) - 1, -1, -1):
+        char = s[i]
+        char_width = 1 if ' ' <= char < '\x7f' else _cached_wcwidth(char)
+        if width + char_width > max_width:
+            return s[i + 1:]
+        width += char_width
+    return s
 
 
 def truncate_str_middle(s: str, max_width: int) -> str:
     """Truncate a string from the middle to fit within a certain width."""
+    half_max_width = max_width // 2 - 1  # for '...'
+    if s.isascii() and s.isprintable():
+        # most paths: 1 column per character, no width tables needed
+        if len(s) <= max_width:
+            return s
+        if half_max_width <= 0:
+            return "..."
+        return s[:half_max_width] + "..." + s[-half_max_width:]
+
     if wcswidth(s) <= max_width:
         return s
 
-    half_max_width = max_width // 2 - 1  # for '...'
     first_half = truncate_str_end(s, half_max_width)
-    second_half = s[::-1]
-    second_half = truncate_str_end(second_half, half_max_width)
-    second_half = second_half[::-1]
+    # scanned from the end in place, instead of truncating a reversed copy
+    second_half = truncate_str_start(s, half_max_width)
 
     return first_half + "..." + second_half
 
 
 def print_progress_inplace(path: Optional[Path] = None,
-                           print_lock: Optional[threading.Lock] = None,
-                           keep_time_interval=True) -> None:
+                           print_lock: Optional[threading.Lock] = None
+                           ) -> None:
     """ print a path in place of the previous line """
-    global last_print_time
-    current_time = time.time()
-    if keep_time_interval and current_time - last_print_time < 0.1:
-        return
-    last_print_time = current_time
-
+    current_time = time.monotonic()
     if path is None:
         path_text = ""
     else:
         path_text = str(path)
+    num_done_files, num_done_dirs, num_done_bytes = get_done_counts()
     items_per_second = (num_done_files + num_done_dirs) / (
         current_time - start_time + 1e-6)
     bytes_per_second = num_done_bytes / (current_time - start_time + 1e-6)
@@ -196,87 +455,332 @@ def print_progress_inplace(path: Optional[Path] = None,
               f'{pretty_size(bytes_per_second)}/s, ' \
               f'elapsed: {pretty_time(current_time - start_time)}'
     if path_text:
-        message += f", current: "
+        message += ", current: "
 
-    terminal_width = shutil.get_terminal_size().columns
-    message_width = wcswidth(message)
-    path_text_width = wcswidth(path_text)
+    terminal_width = get_terminal_width()
+    # only the path can contain wide characters
+    message_width = len(message)
+    path_text_width = _str_width(path_text)
 
+    # pieces of the line, joined once
+    parts = ["\r"]
     if message_width > terminal_width:
-        message = truncate_str_end(message, terminal_width)
+        parts.append(message[:terminal_width])
         message_width = terminal_width
-    elif message_width + path_text_width > terminal_width:
-        path_text = truncate_str_middle(path_text,
-                                        terminal_width - message_width - 3)
-        path_text_width = wcswidth(path_text)
-        message += path_text
-        message_width += path_text_width
     else:
-        message += path_text
+        if message_width + path_text_width > terminal_width:
+            path_text = truncate_str_middle(path_text,
+                                            terminal_width - message_width - 3)
+            path_text_width = _str_width(path_text)
+        parts += (message, path_text)
         message_width += path_text_width
-    message += " " * (terminal_width - message_width)
+    if sys.platform != "win32" and sys.stdout.isatty():
+        # erase the rest of the previous line, whatever the width
+        parts.append("\x1b[K")
+    else:
+        # the classic Windows console does not take escape sequences
+        # unless asked to, and files should not get them
+        parts.append(" " * (terminal_width - message_width))
+    line = "".join(parts)
 
     if print_lock is not None:
         with print_lock:
-            print(f"\r{message}", end="", flush=True)
+            sys.stdout.write(line)
+            sys.stdout.flush()
     else:
-        print(f"\r{message}", end="", flush=True)
-
-
-def call_with_progress_and_try(
-    func: Callable[[Path, Path], None],
-    path: Path,
-    root: Path,
-    is_dir: bool,
-    print_lock: Optional[threading.Lock] = None
-) -> None:
-    """ wrapper to catch exceptions and print progress """
-    global num_done_files, num_done_dirs, num_done_bytes
-    size = path.stat(follow_symlinks=False).st_size
-    try:
-        func(path, root)
-    except:  # noqa
-        import traceback
-        if print_lock is not None:
-            with print_lock:
-                print(f"\rError: {path}\n{traceback.format_exc()}")
-        else:
-            print(f"\rError: {path}\n{traceback.format_exc()}")
-        # abort entire process
-        os._exit(1)  # noqa
-    if is_dir:
-        num_done_dirs += 1
-    else:
-        num_done_files += 1
-    num_done_bytes += size
-    if print_lock is not None:
-        with print_lock:
-            print_progress_inplace(path)
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+
+# messages from workers, written out by a single printer thread
+_message_queue: "queue.SimpleQueue[Optional[str]]" = queue.SimpleQueue()
+_printer_thread: Optional[threading.Thread] = None
+MAX_MESSAGES_PER_WRITE = 256
+# the path a worker handled last, shown by the printer thread. workers
+# only store it, a stale read is fine.
+_current_path: Optional[str] = None
+
+
+def print_message(message: str) -> None:
+    """
+    Print a line from a worker without contending for stdout
+
+    While parallel_recursive_apply() runs, the message is queued and
+    written by the printer thread, batched with other pending messages.
+    Messages from one thread keep their order.
+    """
+    if _printer_thread is None:
+        print(message)
     else:
-        print_progress_inplace(path)
+        _message_queue.put(message)
+
+
+def _print_queued_messages(print_lock: Optional[threading.Lock]) -> None:
+    """
+    printer thread: write queued messages until None is received, and the
+    progress line every PROGRESS_INTERVAL_NS
+    """
+    next_progress_ns = time.monotonic_ns() + PROGRESS_INTERVAL_NS
+    while True:
+        timeout_ns = max(0, next_progress_ns - time.monotonic_ns())
+        try:
+            messages = [_message_queue.get(timeout=timeout_ns / 1e9)]
+        except queue.Empty:
+            messages = []
+        while messages and len(messages) < MAX_MESSAGES_PER_WRITE:
+            try:
+                messages.append(_message_queue.get_nowait())
+            except queue.Empty:
+                break
+        stop = None in messages
+        if stop:
+            messages = [message for message in messages if message is not None]
+        if messages:
+            if print_lock is not None:
+                with print_lock:
+                    sys.stdout.write("\n".join(messages) + "\n")
+                    sys.stdout.flush()
+            else:
+                sys.stdout.write("\n".join(messages) + "\n")
+                sys.stdout.flush()
+        if stop:
+            return
+        now_ns = time.monotonic_ns()
+        if now_ns >= next_progress_ns:
+            print_progress_inplace(_current_path, print_lock)
+            next_progress_ns = now_ns + PROGRESS_INTERVAL_NS
+
+
+def _start_printer(print_lock: Optional[threading.Lock] = None) -> None:
+    """
+    start the printer thread used by print_message(), which also prints
+    the progress
+    """
+    global _printer_thread, _current_path
+    _current_path = None
+    _printer_thread = threading.Thread(target=_print_queued_messages,
+                                       args=(print_lock,), daemon=True)
+    _printer_thread.start()
+
+
+def _stop_printer() -> None:
+    """ write all queued messages and stop the printer thread """
+    global _printer_thread
+    _message_queue.put(None)
+    _printer_thread.join()
+    _printer_thread = None
+
+
+# set by the first task that fails
+_abort = threading.Event()
+
+
+def make_task(func: Callable[[Any, Path, os.stat_result], None],
+              is_dir: bool,
+              path_type: Callable[[str], Any] = Path
+              ) -> Callable[..., None]:
+    """
+    wrap func to catch exceptions and print progress
+
+    The returned task(path, root, entry=None, st=None) is specific to func
+    and is_dir, so a call does not merge bound keyword arguments the way
+    a partial of a generic wrapper does. The walker hands over path as a
+    str, and path_type(path) is only built in the worker, for func. After
+    an error, the remaining tasks return without calling func.
+    """
+    def task(path: str, root: Path, entry: Optional[os.DirEntry] = None,
+             st: Optional[os.stat_result] = None) -> None:
+        global _current_path
+        if _abort.is_set():
+            return
+        try:
+            # taken once here, unless given, and handed to func, which is
+            # spared its own stat. the stat of the scandir() entry of path
+            # is free on Windows, and cached by the walker for directories.
+            if st is None:
+                try:
+                    if entry is not None:
+                        st = entry.stat(follow_symlinks=False)
+                    else:
+                        st = os.lstat(path)
+                except FileNotFoundError:
+                    # removed since listed -> skip
+                    return
+            func(path if path_type is str else path_type(path), root, st)
+        except:  # noqa
+            # other errors of the stat as well, which would otherwise be
+            # left in the Future of a chunk of files, with the rest of it
+            import traceback
+            print_message(f"\rError: {path}\n{traceback.format_exc()}")
+            # abort the traversal. parallel_recursive_apply() exits once
+            # the tasks already submitted have returned.
+            _abort.set()
+            return
+        # no other thread writes these, so no lock or atomic is needed
+        counters = _get_done_counters()
+        if is_dir:
+            counters.dirs += 1
+        else:
+            counters.files += 1
+        counters.bytes += st.st_size
+        # printed by the printer thread
+        _current_path = path
+    return task
+
+
+# no worker waits for another task, so a few threads per core are enough
+# to keep the disk busy through the syscalls that release the GIL
+DEFAULT_NUM_MAX_THREADS = min(32, (os.cpu_count() or 4) * 4)
+
+# tasks submitted but not done, at most. about 1 KiB each.
+MAX_PENDING_TASKS = 100_000
+
+
+class BoundedThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    ThreadPoolExecutor whose submit() blocks while max_pending tasks are
+    queued or running, and whose join() waits for the tasks submitted by
+    other tasks as well
+
+    The traversal can list entries much faster than they are processed,
+    and would otherwise hold a Future and a work item for every entry of
+    the tree before the workers catch up.
+    """
+
+    def __init__(self, max_workers: int, max_pending: int) -> None:
+        super().__init__(max_workers=max_workers)
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._num_unfinished = 0
+        self._idle = threading.Condition()
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        self.reserve()
+        return self.submit_reserved(fn, *args, **kwargs)
+
+    def reserve(self) -> None:
+        """ wait for a free slot, for a later submit_reserved() """
+        self._pending.acquire()
+
+    def submit_reserved(self, fn, /, *args, **kwargs) -> Future:
+        """
+        submit() into a slot taken by reserve()
+
+        For tasks submitted later by other tasks, that must not wait for a
+        slot but must still count against max_pending.
+        """
+        return self._submit(True, fn, args, kwargs)
+
+    def submit_nowait(self, fn, /, *args, **kwargs) -> Future:
+        """
+        submit() without waiting for a free slot
+
+        For tasks submitting their continuations: a worker waiting for a
+        slot may be the one that would free it.
+        """
+        return self._submit(False, fn, args, kwargs)
+
+    def join(self) -> None:
+        """ wait until all tasks are done, including ones they submitted """
+        with self._idle:
+            self._idle.wait_for(lambda: not self._num_unfinished)
+
+    def _submit(self, bounded: bool, fn, args, kwargs) -> Future:
+        with self._idle:
+            self._num_unfinished += 1
+        try:
+            return super().submit(self._run, bounded, fn, args, kwargs)
+        except BaseException:
+            self._finish(bounded)
+            raise
+
+    def _run(self, bounded: bool, fn, args, kwargs) -> Any:
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            # after fn, so that tasks submitted by fn are already counted
+            self._finish(bounded)
+
+    def _finish(self, bounded: bool) -> None:
+        if bounded:
+            self._pending.release()
+        with self._idle:
+            self._num_unfinished -= 1
+            if not self._num_unfinished:
+                self._idle.notify_all()
+
+
+class _Countdown:
+    """ call func when done() has been called count times """
+    __slots__ = ('count', 'func', 'lock')
+
+    def __init__(self, count: int, func: Callable[[], Any]) -> None:
+        self.count = count
+        self.func = func
+        self.lock = threading.Lock()
+
+    def done(self, *_) -> None:
+        """ count down. also usable as a done callback of a Future """
+        with self.lock:
+            self.count -= 1
+            if self.count:
+                return
+        self.func()
+
+
+def _run_then(func: Callable[[], Any], then: Callable[[], Any]) -> None:
+    """ task running func, then its continuation """
+    try:
+        func()
+    finally:
+        then()
+
+
+# files of a directory applied by one task, at most. a slow file holds up
+# the others of its chunk only.
+FILES_PER_TASK = 64
+
 
+def _call_each(func: Callable[..., Any], root: Path,
+               entries: List[os.DirEntry]) -> None:
+    """ task applying func to several scandir() entries in turn """
+    for entry in entries:
+        func(entry.path, root, entry=entry)
 
-def after_futures_done(futures: Iterable[Future],
-                       func: Callable[[], None]) -> None:
-    """ apply func after all futures are done """
-    wait(futures)
-    func()
+
+def _submit_after(executor: BoundedThreadPoolExecutor, done: Future,
+                  tasks: List[Callable[[], Any]]) -> None:
+    """ submit tasks once done is set, without parking a worker until then """
+    for task in tasks:
+        # the walker waits for a slot even for a deferred task, so that
+        # the tasks waiting for their parent count against max_pending
+        executor.reserve()
+        if done.done():
+            # usual case, as the walker lags behind the workers
+            executor.submit_reserved(task)
+        else:
+            # runs in the task setting done, which must not wait for a slot
+            done.add_done_callback(
+                lambda _, task=task: executor.submit_reserved(task))
 
 
 def parallel_recursive_apply(
     paths: List[str],
-    dir_func: Callable[[Path, Path], Any],
-    file_func: Callable[[Path, Path], Any],
+    dir_func: Callable[[Any, Path, os.stat_result], Any],
+    file_func: Callable[[Any, Path, os.stat_result], Any],
     pre_order: bool = True,
-    num_max_threads: int = 512,
+    num_max_threads: int = DEFAULT_NUM_MAX_THREADS,
     strict_hierarchical_order: bool = True,
-    print_lock: Optional[threading.Lock] = None) -> None:
+    print_lock: Optional[threading.Lock] = None,
+    max_pending_tasks: int = MAX_PENDING_TASKS,
+    path_type: Callable[[str], Any] = Path) -> None:
     """
     Apply dir_func and file_func to all files and directories in paths
 
     :param paths: List of paths to visit
-    :param dir_func: (path, root_path) -> Any. Function to apply to a directory
-    :param file_func: (path, root_path) -> Any. Function to apply to a file
+    :param dir_func: (path, root_path, lstat_result) -> Any. Function to
+        apply to a directory
+    :param file_func: (path, root_path, lstat_result) -> Any. Function to
+        apply to a file
     :param pre_order: If True, apply dir_func before applying file_func
         to the files in a directory. If False, apply file_func before
         applying dir_func to the directories in a directory.
@@ -289,101 +793,214 @@ def parallel_recursive_apply(
         all their children are done (for pre_order=False).
     :param print_lock: If not None, use this lock to print progress and
         error messages.
+    :param max_pending_tasks: Maximum number of tasks submitted but not
+        done. Traversal waits for the workers beyond it.
+    :param path_type: Type of the path passed to dir_func and file_func,
+        built from its str. Functions that only hand the path to os can
+        take str, and spare a Path per item.
+
+    If dir_func or file_func raises, the error is printed, the traversal
+    stops and the process exits with status 1.
     """
     global start_time
-    start_time = time.time()
-
-    dir_func = functools.partial(call_with_progress_and_try, dir_func,
-                                 is_dir=True, print_lock=print_lock)
-    file_func = functools.partial(call_with_progress_and_try, file_func,
-                                  is_dir=False, print_lock=print_lock)
-    drive_letter_regex = re.compile(r"^[a-zA-Z]:$")
-    with ThreadPoolExecutor(max_workers=num_max_threads) as executor:
+    start_time = time.monotonic()
+    reset_done_counts()
+    _abort.clear()
+
+    dir_func = make_task(dir_func, True, path_type)
+    file_func = make_task(file_func, False, path_type)
+    previous_sigwinch_handler = _install_sigwinch_handler()
+    _start_printer(print_lock)
+    try:
+        _run_traversal(paths, dir_func, file_func, pre_order,
+                       num_max_threads, strict_hierarchical_order,
+                       max_pending_tasks)
+    finally:
+        # also on KeyboardInterrupt, after the messages of the workers
+        _stop_printer()
+        _restore_sigwinch_handler(previous_sigwinch_handler)
+    if _abort.is_set():
+        sys.exit(1)
+
+    print_progress_inplace()
+    print()
+
+
+def _run_traversal(paths: List[str],
+                   dir_func: Callable[..., Any],
+                   file_func: Callable[..., Any],
+                   pre_order: bool,
+                   num_max_threads: int,
+                   strict_hierarchical_order: bool,
+                   max_pending_tasks: int) -> None:
+    """ submit the tasks of all paths and wait for them """
+    with BoundedThreadPoolExecutor(num_max_threads,
+                                   max_pending_tasks) as executor:
         for path in paths:
+            if _abort.is_set():
+                break
             # workaround for https://github.com/python/cpython/issues/80486
-            if drive_letter_regex.fullmatch(path) is not None:
+            if _DRIVE_LETTER_REGEX.fullmatch(path) is not None:
                 path += '/'
-            if not os.path.isdir(path):
-                executor.submit(file_func, Path(path))
+            # the walk starts from the str of the root given to the
+            # callbacks (e.g. 'src' for './src'), so that the paths below
+            # it start with that str
+            path = os.fspath(Path(path))
+            # the lstat() handed to the callback of path, and the only
+            # stat of path unless it is a link
+            try:
+                st = os.lstat(path)
+            except OSError:
+                # removed since listed
+                continue
+            if stat.S_ISLNK(st.st_mode):
+                # a link to a directory is walked as the directory, so its
+                # callback gets the stat() of the directory: the mode of
+                # the link itself is 0o120777
+                try:
+                    target_st = os.stat(path)
+                except OSError:
+                    # dangling link
+                    target_st = None
+                if target_st is not None and stat.S_ISDIR(target_st.st_mode):
+                    st = target_st
+            if not stat.S_ISDIR(st.st_mode):
+                # a file is its own root
+                executor.submit(file_func, path, Path(path), st=st)
                 continue
             if pre_order:
-                _parallel_pre_order_apply(path,
+                _parallel_pre_order_apply(path, st,
                                           dir_func, file_func,  # type: ignore
                                           executor, strict_hierarchical_order)
             else:
-                _parallel_post_order_apply(path,
+                _parallel_post_order_apply(path, st,
                                            dir_func, file_func,  # type: ignore
                                            executor, strict_hierarchical_order)
-
-    print_progress_inplace(keep_time_interval=False)
-    print()
+        # some tasks are only submitted when others are done
+        executor.join()
 
 
 def _parallel_pre_order_apply(root_dir: str,
-                              dir_func: Callable[[Path, Path], Any],
-                              file_func: Callable[[Path, Path], Any],
-                              executor: ThreadPoolExecutor,
+                              root_stat: os.stat_result,
+                              dir_func: Callable[..., Any],
+                              file_func: Callable[..., Any],
+                              executor: BoundedThreadPoolExecutor,
                               strict_hierarchical_order: bool) -> None:
     """ pre-order apply """
+    root_path = os.fspath(root_dir)
     root_dir = Path(root_dir)
-    parent_future = executor.submit(dir_func, root_dir, root_dir)
-    dirpath_to_future = {root_dir: parent_future}
-
-    for parent, dirnames, filenames in os.walk(root_dir, followlinks=False):
-        parent = Path(parent)
-        parent_future = dirpath_to_future.pop(parent)
-        prune_dir_indexes = []
-        for i, dirname in enumerate(dirnames):
-            dirpath = parent / dirname
-            if FileType.from_path(dirpath) != FileType.DIRECTORY:
+    root_call = functools.partial(dir_func, root_path, root_dir, st=root_stat)
+    # set when the dir_func of a directory is done, from within its task.
+    # only needed to order the children. paths stay str in this loop, and
+    # become Path in the workers.
+    dirpath_to_future: Dict[str, Future] = {}
+    if strict_hierarchical_order:
+        root_done = Future()
+        dirpath_to_future[root_path] = root_done
+        executor.submit(_run_then, root_call,
+                        functools.partial(root_done.set_result, None))
+    else:
+        executor.submit(root_call)
+
+    for parent, dir_entries, file_entries in walk_pre_order(root_path):
+        if _abort.is_set():
+            return
+        tasks = []
+        walk_dir_entries = []
+        for entry in dir_entries:
+            if FileType.from_entry(entry) != FileType.DIRECTORY:
                 # symlink, junction, etc. -> treat as file, and don't recurse
-                filenames.append(dirname)
-                prune_dir_indexes.append(i)
+                file_entries.append(entry)
                 continue
-            future = executor.submit(
-                after_futures_done,
-                [parent_future] if strict_hierarchical_order else [],
-                lambda path=dirpath: dir_func(path, root_dir))
-            dirpath_to_future[dirpath] = future
-        for i in reversed(prune_dir_indexes):
-            del dirnames[i]
-        for filename in filenames:
-            filepath = parent / filename
-            if not os.path.lexists(filepath):
-                # nonexistent -> skip
+            walk_dir_entries.append(entry)
+            dir_call = functools.partial(dir_func, entry.path, root_dir,
+                                         entry=entry)
+            if not strict_hierarchical_order:
+                tasks.append(dir_call)
                 continue
-            executor.submit(
-                after_futures_done,
-                [parent_future] if strict_hierarchical_order else [],
-                lambda path=filepath: file_func(path, root_dir))
+            done = Future()
+            dirpath_to_future[entry.path] = done
+            tasks.append(functools.partial(
+                _run_then, dir_call,
+                functools.partial(done.set_result, None)))
+        dir_entries[:] = walk_dir_entries
+        # entries removed since listed are skipped by their task
+        for i in range(0, len(file_entries), FILES_PER_TASK):
+            tasks.append(functools.partial(
+                _call_each, file_func, root_dir,
+                file_entries[i:i + FILES_PER_TASK]))
+        if strict_hierarchical_order:
+            # children are submitted by the task of their parent
+            _submit_after(executor, dirpath_to_future.pop(parent), tasks)
+        else:
+            for task in tasks:
+                executor.submit(task)
 
 
 def _parallel_post_order_apply(root_dir: str,
-                               dir_func: Callable[[Path, Path], Any],
-                               file_func: Callable[[Path, Path], Any],
-                               executor: ThreadPoolExecutor,
+                               root_stat: os.stat_result,
+                               dir_func: Callable[..., Any],
+                               file_func: Callable[..., Any],
+                               executor: BoundedThreadPoolExecutor,
                                strict_hierarchical_order: bool) -> None:
     """ post-order apply """
+    root_path = os.fspath(root_dir)
     root_dir = Path(root_dir)
-    dirpath_to_future = {}
-    for parent, dirnames, filenames in walk_post_order(root_dir):
-        parent = Path(parent)
+    # set when the dir_func of a directory is done. only needed to order
+    # the parents. paths stay str in this loop, and become Path in the
+    # workers.
+    dirpath_to_future: Dict[str, Future] = {}
+    for parent, parent_entry, dir_entries, file_entries in \
+            walk_post_order(root_path):
+        if _abort.is_set():
+            return
         child_futures = []
-        for dirname in dirnames:
-            dirpath = parent / dirname
-            if FileType.from_path(dirpath) != FileType.DIRECTORY:
-                filenames.append(dirname)
+        for entry in dir_entries:
+            if FileType.from_entry(entry) != FileType.DIRECTORY:
+                file_entries.append(entry)
                 continue
-            child_futures.append(dirpath_to_future.pop(parent / dirname))
-
-        for filename in filenames:
-            filepath = parent / filename
-            # there's some symlinks to directories in the filenames
-            future = executor.submit(file_func, filepath, root_dir)
-            child_futures.append(future)
-
-        future = executor.submit(
-            after_futures_done,
-            child_futures if strict_hierarchical_order else [],
-            lambda path=parent: dir_func(path, root_dir))
-        dirpath_to_future[parent] = future
+            if strict_hierarchical_order:
+                child_futures.append(dirpath_to_future.pop(entry.path))
+
+        if parent_entry is not None:
+            dir_call = functools.partial(dir_func, parent, root_dir,
+                                         entry=parent_entry)
+        else:
+            # the root has no entry, and was stat'ed by the caller
+            dir_call = functools.partial(dir_func, parent, root_dir,
+                                         st=root_stat)
+        # there's some symlinks to directories in the file entries
+        file_tasks = [
+            functools.partial(_call_each, file_func, root_dir,
+                              file_entries[i:i + FILES_PER_TASK])
+            for i in range(0, len(file_entries), FILES_PER_TASK)]
+        if not strict_hierarchical_order:
+            for task in file_tasks:
+                executor.submit(task)
+            executor.submit(dir_call)
+            continue
+
+        done = Future()
+        dirpath_to_future[parent] = done
+        dir_task = functools.partial(_run_then, dir_call,
+                                     functools.partial(done.set_result, None))
+        if not child_futures and len(file_tasks) <= 1:
+            # a small leaf directory: its files, then itself, in one task
+            if file_tasks:
+                executor.submit(_run_then, file_tasks[0], dir_task)
+            else:
+                executor.submit(dir_task)
+            continue
+
+        # Submit the directory when the last of its children is done,
+        # instead of parking a worker on wait() until then. The walker
+        # holds one count until all children are counted, so that
+        # children done early cannot submit it too soon.
+        countdown = _Countdown(1 + len(child_futures) + len(file_tasks),
+                               functools.partial(executor.submit_nowait,
+                                                 dir_task))
+        for future in child_futures:
+            future.add_done_callback(countdown.done)
+        for task in file_tasks:
+            executor.submit(_run_then, task, countdown.done)
+        countdown.done()
@@ -72,6 +72,20 @@ class ReparseTag(Enum):
     IO_REPARSE_TAG_WCI_LINK_1 = 0xA0001027
 
 
+def _read_path_buffer(path_buffer: ctypes.Array, offset: int,
+                      length: int) -> bytes:
+    """
+    Copy length bytes at offset of a PathBuffer field in one memcpy.
+    Slicing the c_byte array instead builds a list of ints first.
+    """
+    return ctypes.string_at(ctypes.addressof(path_buffer) + offset, length)
+
+
+# ReparseTag(value) goes through Enum.__call__, and raises for tags that
+# are not listed. unknown tags are returned as int.
+_REPARSE_TAGS = {tag.value: tag for tag in ReparseTag}
+
+
 class SymbolicLinkReparseBufferType(ctypes.Structure):
     _fields_ = [
         ("SubstituteNameOffset", wintypes.USHORT),
@@ -85,17 +99,15 @@ class SymbolicLinkReparseBufferType(ctypes.Structure):
 
     @property
     def substitute_name(self):
-        return bytes(self.PathBuffer[self.SubstituteNameOffset:
-                                     self.SubstituteNameOffset +
-                                     self.SubstituteNameLength]) \
-            .decode("utf-16")
+        return _read_path_buffer(self.PathBuffer, self.SubstituteNameOffset,
+                                 self.SubstituteNameLength) \
+            .decode("utf-16-le")
 
     @property
     def print_name(self):
-        return bytes(self.PathBuffer[self.PrintNameOffset:
-                                     self.PrintNameOffset +
-                                     self.PrintNameLength]) \
-            .decode("utf-16")
+        return _read_path_buffer(self.PathBuffer, self.PrintNameOffset,
+                                 self.PrintNameLength) \
+            .decode("utf-16-le")
 
     @property
     def is_relative(self):
@@ -114,17 +126,15 @@ class MountPointReparseBufferType(ctypes.Structure):
 
     @property
     def substitute_name(self):
-        return bytes(self.PathBuffer[self.SubstituteNameOffset:
-                                     self.SubstituteNameOffset +
-                                     self.SubstituteNameLength]) \
-            .decode("utf-16")
+        return _read_path_buffer(self.PathBuffer, self.SubstituteNameOffset,
+                                 self.SubstituteNameLength) \
+            .decode("utf-16-le")
 
     @property
     def print_name(self):
-        return bytes(self.PathBuffer[self.PrintNameOffset:
-                                     self.PrintNameOffset +
-                                     self.PrintNameLength]) \
-            .decode("utf-16")
+        return _read_path_buffer(self.PathBuffer, self.PrintNameOffset,
+                                 self.PrintNameLength) \
+            .decode("utf-16-le")
 
 
 class GenericReparseBufferType(ctypes.Structure):
@@ -149,13 +159,15 @@ class LxSymlinkReparseBufferType(ctypes.Structure):
 
     @property
     def substitute_name(self):
-        path_buffer = bytes(self.PathBuffer)
         if not hasattr(self, "SubstituteNameLength") or \
             self.SubstituteNameLength is None:
             # treat as a null-terminated string
+            path_buffer = bytes(self.PathBuffer)
             return path_buffer[:path_buffer.find(b"\x00")].decode("utf-8")
         else:
-            return path_buffer[:self.SubstituteNameLength].decode("utf-8")
+            return _read_path_buffer(self.PathBuffer, 0,
+                                     self.SubstituteNameLength) \
+                .decode("utf-8")
 
 
 class ReparseBufferType(ctypes.Union):
@@ -218,7 +230,7 @@ def is_reparse_point(file_path: Union[str, bytes, os.PathLike]) -> bool:
 
 
 def get_reparse_info(file_path: Union[os.PathLike, str, bytes]) -> \
-    Tuple[ReparseTag, Union[
+    Tuple[Union[ReparseTag, int], Union[
         SymbolicLinkReparseBufferType,
         MountPointReparseBufferType,
         GenericReparseBufferType,
@@ -227,7 +239,8 @@ def get_reparse_info(file_path: Union[os.PathLike, str, bytes]) -> \
     Get reparse information for the given file path.
 
     :param file_path: The file path to retrieve reparse information for.
-    :return: A tuple containing the reparse tag and a reparse buffer object.
+    :return: A tuple containing the reparse tag (an int if it is not a
+        ReparseTag) and a reparse buffer object.
     """
     file_path = os.fspath(file_path)
     h_file = CreateFile(
@@ -258,12 +271,13 @@ def get_reparse_info(file_path: Union[os.PathLike, str, bytes]) -> \
         if not result:
             raise ctypes.WinError()
 
-        tag = ReparseTag(data_buffer.ReparseTag)
-        if tag == ReparseTag.IO_REPARSE_TAG_SYMLINK:
+        raw_tag = data_buffer.ReparseTag
+        tag = _REPARSE_TAGS.get(raw_tag, raw_tag)
+        if tag is ReparseTag.IO_REPARSE_TAG_SYMLINK:
             return tag, data_buffer.ReparseBuffer.SymbolicLinkReparseBuffer
-        elif tag == ReparseTag.IO_REPARSE_TAG_MOUNT_POINT:
+        elif tag is ReparseTag.IO_REPARSE_TAG_MOUNT_POINT:
             return tag, data_buffer.ReparseBuffer.MountPointReparseBuffer
-        elif tag == ReparseTag.IO_REPARSE_TAG_LX_SYMLINK:
+        elif tag is ReparseTag.IO_REPARSE_TAG_LX_SYMLINK:
             data_buffer.ReparseBuffer.LxSymlinkReparseBuffer \
                 .set_substitute_name_length(data_buffer.ReparseDataLength - 4)
             return tag, data_buffer.ReparseBuffer.LxSymlinkReparseBuffer
@@ -0,0 +1,57 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from parallel_cp_r import parallel_cp_r
+
+
+def list_tree(top: str):
+    """ relative paths of everything below top """
+    return sorted(os.path.relpath(os.path.join(parent, name), top)
+                  for parent, dirnames, filenames in os.walk(top)
+                  for name in dirnames + filenames)
+
+
+class RootTest(unittest.TestCase):
+    """ roots are copied as the directories or files they name """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.old_cwd = os.getcwd()
+        os.chdir(self.tmp.name)
+        self.addCleanup(os.chdir, self.old_cwd)
+        os.makedirs('src/sub/deep')
+        Path('src/x').write_text('x')
+        Path('src/sub/y').write_text('y')
+        Path('src/sub/deep/z').write_text('z')
+
+    def test_dot_slash_root(self):
+        parallel_cp_r(['./src'], 'dst')
+        self.assertEqual(list_tree('dst'), list_tree('src'))
+        self.assertEqual(Path('dst/sub/deep/z').read_text(), 'z')
+
+    def test_doubled_separator_root(self):
+        parallel_cp_r([f'src{os.sep}{os.sep}sub'], 'dst')
+        self.assertEqual(list_tree('dst'), list_tree('src/sub'))
+
+    def test_roots_as_children(self):
+        os.mkdir('dst')
+        parallel_cp_r(['./src', f'src{os.sep}{os.sep}sub', './src/x'], 'dst')
+        self.assertEqual(list_tree('dst/src'), list_tree('src'))
+        self.assertEqual(list_tree('dst/sub'), list_tree('src/sub'))
+        self.assertEqual(Path('dst/x').read_text(), 'x')
+
+    @unittest.skipUnless(hasattr(os, 'symlink') and os.name == 'posix',
+                         'needs POSIX symlinks and modes')
+    def test_link_to_directory_root(self):
+        os.chmod('src', 0o750)
+        os.symlink('src', 'link')
+        parallel_cp_r(['link'], 'dst')
+        self.assertEqual(list_tree('dst'), list_tree('src'))
+        self.assertEqual(os.lstat('dst').st_mode, os.stat('src').st_mode)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import parallel_diff_tree
+from parallel_diff_tree import parallel_diff_tree as diff_tree
+
+
+class MissingDestinationTest(unittest.TestCase):
+    """ paths that Path.exists() takes for missing are reported deleted """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.src = os.path.join(self.tmp.name, 'src')
+        self.dest = os.path.join(self.tmp.name, 'dest')
+        os.makedirs(os.path.join(self.src, 'sub'))
+        os.mkdir(self.dest)
+        for name in ('f', os.path.join('sub', 'g')):
+            with open(os.path.join(self.src, name), 'w') as file:
+                file.write(name)
+
+    def diff(self):
+        messages = []
+        with mock.patch.object(parallel_diff_tree, 'print_message',
+                               messages.append):
+            diff_tree(self.src, self.dest)
+        return [message.strip() for message in messages]
+
+    @unittest.skipUnless(os.name == 'posix', 'needs POSIX symlinks')
+    def test_symlink_loop(self):
+        os.symlink('f', os.path.join(self.dest, 'f'))
+        os.symlink('sub', os.path.join(self.dest, 'sub'))
+        self.assertCountEqual(self.diff(), [
+            f'DELETED File: {os.path.join(self.src, "f")} -> x',
+            f'DELETED Dir: {os.path.join(self.src, "sub")} -> x',
+            f'DELETED File: {os.path.join(self.src, "sub", "g")} -> x',
+        ])
+
+    def test_parent_is_a_file(self):
+        with open(os.path.join(self.dest, 'sub'), 'w'):
+            pass
+        with open(os.path.join(self.dest, 'f'), 'w') as file:
+            file.write('f')
+        self.assertCountEqual(self.diff(), [
+            f'PROPERTY CHANGED [DIR]{os.path.join(self.src, "sub")} -> '
+            f'[FILE]{os.path.join(self.dest, "sub")}',
+            f'DELETED File: {os.path.join(self.src, "sub", "g")} -> x',
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
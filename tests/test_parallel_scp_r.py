@@ -0,0 +1,43 @@
+import os
+import tempfile
+import threading
+import unittest
+from pathlib import PurePosixPath
+
+from parallel_traversal import parallel_recursive_apply, get_dest_path
+
+
+class RemotePathTest(unittest.TestCase):
+    """ remote paths of the walked tree, without a server """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.old_cwd = os.getcwd()
+        os.chdir(self.tmp.name)
+        self.addCleanup(os.chdir, self.old_cwd)
+        os.makedirs('src/sub')
+        open('src/sub/y', 'w').close()
+
+    def remote_paths(self, root: str):
+        paths = set()
+        lock = threading.Lock()
+
+        def collect(src, src_root, _stat):
+            with lock:
+                paths.add(get_dest_path(src, src_root,
+                                        PurePosixPath('/dst'), True))
+        parallel_recursive_apply([root], collect, collect, path_type=str)
+        return paths
+
+    def test_dot_slash_root(self):
+        self.assertEqual(self.remote_paths('./src'),
+                         {'/dst/src', '/dst/src/sub', '/dst/src/sub/y'})
+
+    def test_doubled_separator_root(self):
+        self.assertEqual(self.remote_paths(f'src{os.sep}{os.sep}sub'),
+                         {'/dst/sub', '/dst/sub/y'})
+
+
+if __name__ == '__main__':
+    unittest.main()
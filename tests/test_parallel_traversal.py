@@ -0,0 +1,135 @@
+import contextlib
+import io
+import os
+import signal
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import parallel_traversal
+from parallel_traversal import parallel_recursive_apply, make_task, \
+    _call_each
+
+
+class MaxPendingTest(unittest.TestCase):
+    """ the walker does not run ahead of the workers by more than the cap """
+
+    MAX_PENDING = 8
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        for i in range(20):
+            for j in range(20):
+                sub = os.path.join(self.tmp.name, str(i), str(j))
+                os.makedirs(sub)
+                for name in 'ab':
+                    open(os.path.join(sub, name), 'w').close()
+
+    def test_strict_pre_order(self):
+        lock = threading.Lock()
+        num_listed = num_done = max_ahead = 0
+        walk_pre_order = parallel_traversal.walk_pre_order
+
+        def counting_walk(top):
+            nonlocal num_listed, max_ahead
+            for parent, dirs, nondirs in walk_pre_order(top):
+                with lock:
+                    num_listed += len(dirs) + len(nondirs)
+                    max_ahead = max(max_ahead, num_listed - num_done)
+                yield parent, dirs, nondirs
+
+        def slow_apply(_path, _root, _stat):
+            nonlocal num_done
+            time.sleep(0.001)
+            with lock:
+                num_done += 1
+
+        with mock.patch.object(parallel_traversal, 'walk_pre_order',
+                               counting_walk):
+            parallel_recursive_apply([self.tmp.name], slow_apply, slow_apply,
+                                     num_max_threads=4,
+                                     max_pending_tasks=self.MAX_PENDING)
+        self.assertEqual(num_done, 20 + 20 * 20 * 3 + 1)
+        # each slot holds a directory or a chunk of its 2 files, on top of
+        # the directory just listed
+        self.assertLessEqual(max_ahead, self.MAX_PENDING * 2 + 20)
+
+
+class _UnstatableEntry:
+    """ a scandir() entry whose stat() fails """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def stat(self, follow_symlinks=True):
+        raise PermissionError(13, 'Permission denied', self.path)
+
+
+class StatErrorTest(unittest.TestCase):
+    """ a failing stat of an entry aborts the traversal like func failing """
+
+    def setUp(self):
+        parallel_traversal._abort.clear()
+        self.addCleanup(parallel_traversal._abort.clear)
+
+    def test_chunk_of_files(self):
+        visited = []
+        task = make_task(lambda path, _root, _stat: visited.append(path),
+                         is_dir=False)
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            _call_each(task, Path('root'),
+                       [_UnstatableEntry('root/a'), _UnstatableEntry('root/b')])
+        self.assertTrue(parallel_traversal._abort.is_set())
+        self.assertEqual(visited, [])
+        self.assertIn('Error: root/a', output.getvalue())
+        self.assertIn('PermissionError', output.getvalue())
+
+
+class PrinterTest(unittest.TestCase):
+    """ the printer thread does not outlive parallel_recursive_apply() """
+
+    def test_stopped_on_interrupt(self):
+        with mock.patch.object(parallel_traversal, '_run_traversal',
+                               side_effect=KeyboardInterrupt), \
+                self.assertRaises(KeyboardInterrupt):
+            parallel_recursive_apply(['.'], print, print)
+        self.assertIsNone(parallel_traversal._printer_thread)
+
+
+@unittest.skipUnless(hasattr(signal, 'SIGWINCH'), 'needs SIGWINCH')
+class SigwinchTest(unittest.TestCase):
+    """ the SIGWINCH handler is only set during the traversal """
+
+    def setUp(self):
+        previous_handler = signal.signal(signal.SIGWINCH, self.handler)
+        self.addCleanup(signal.signal, signal.SIGWINCH, previous_handler)
+        self.handlers = []
+
+    def handler(self, *_):
+        pass
+
+    def record_handler(self, _path, _root, _stat):
+        self.handlers.append(signal.getsignal(signal.SIGWINCH))
+
+    def test_main_thread(self):
+        parallel_recursive_apply([__file__], self.record_handler,
+                                 self.record_handler)
+        self.assertEqual(self.handlers,
+                         [parallel_traversal._invalidate_terminal_width])
+        self.assertEqual(signal.getsignal(signal.SIGWINCH), self.handler)
+
+    def test_other_thread(self):
+        thread = threading.Thread(
+            target=parallel_recursive_apply,
+            args=([__file__], self.record_handler, self.record_handler))
+        thread.start()
+        thread.join()
+        self.assertEqual(self.handlers, [self.handler])
+
+
+if __name__ == '__main__':
+    unittest.main()